@@ -0,0 +1,39 @@
+# Gunicorn picks this file up automatically when started from the project
+# directory: `gunicorn main:app`. Without an explicit bind it listens on
+# 0.0.0.0:$PORT when PORT is set.
+
+import os
+
+# Import main.py once in the master so yt-dlp, Flask and the option tables are
+# loaded before fork and shared copy-on-write by the workers, instead of every
+# worker re-importing them on boot and on each restart.
+preload_app = True
+
+# Requests spend nearly all of their time blocked on yt-dlp network I/O, so each
+# worker runs a pool of threads rather than serving one request at a time.
+# main.MAX_CONCURRENT_DOWNLOADS caps how many of those threads download at once.
+# GUNICORN_WORKER_CLASS=gevent swaps the threads for greenlets, which lets one
+# worker hold far more idle connections (long /stream_song and /audio transfers).
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+if worker_class == 'gevent':
+    # Patch here, before main.py is preloaded, so the locks, threads and sockets
+    # it creates at import time are already the cooperative versions.
+    from gevent import monkey
+    monkey.patch_all()
+
+# /audio and cached /stream_song responses go out through send_file, which hands
+# the open file to gunicorn's wsgi.file_wrapper; with sendfile on, the kernel
+# copies it to the socket instead of Python reading and writing 8KB blocks.
+# This is gunicorn's default already; it is pinned so SENDFILE in the
+# environment cannot silently turn it off.
+sendfile = True
+
+def post_fork(server, worker):
+    # main.py does not start its janitor threads on import, so the preloading
+    # master never runs one; each worker starts its own here after the fork.
+    from main import start_background_threads
+    start_background_threads()
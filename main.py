@@ -1,45 +1,573 @@
 import os
+import atexit
 import logging
-import json
-import uuid
-from flask import Flask, request, jsonify, send_from_directory
+from logging.handlers import QueueHandler, QueueListener
+import glob
+import queue
+import itertools
+import secrets
+import weakref
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory, abort, redirect
+from werkzeug.security import safe_join
 from flask_cors import CORS
+import orjson
+from flask.json.provider import JSONProvider
 import yt_dlp
-from threading import Thread
+from ytmusicapi import YTMusic
+from yt_dlp.networking import Request as YtdlRequest
+from yt_dlp.networking.exceptions import HTTPError as UpstreamHTTPError
+from cachetools import TTLCache
+from threading import Thread, Lock, BoundedSemaphore
 import time
+from collections import OrderedDict
+from types import MappingProxyType
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, Future
 
 # --- Setup ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+# Records are handed to a listener thread so request threads never block on
+# writing to stderr.
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+
+def _start_log_listener():
+    # Threads do not survive fork, so each worker process starts its own. Under
+    # gevent the parent's listener greenlet may carry over as well; two
+    # listeners draining the same queue only share the work.
+    global _log_listener
+    _log_listener = QueueListener(_log_queue, _log_handler)
+    _log_listener.start()
+
+_start_log_listener()
+# register_at_fork does not exist on Windows, where there is no fork to handle.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_start_log_listener)
+atexit.register(lambda: _log_listener.stop())
+# QueueHandler.prepare() formats the record into its message before queueing,
+# so it must only merge the args; the listener's handler adds the prefix.
+logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[QueueHandler(_log_queue)])
 logger = logging.getLogger(__name__)
+
+
+class OrjsonProvider(JSONProvider):
+    """Encode jsonify() responses with orjson, which returns bytes directly."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app, resources={r"/*": {"origins": "*"}})
 TEMP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp_audio')
-if not os.path.exists(TEMP_DIR):
-    os.makedirs(TEMP_DIR)
+CACHE_DIR = os.path.join(TEMP_DIR, 'cache')
+os.makedirs(CACHE_DIR, exist_ok=True)
+# yt-dlp keeps the deciphered YouTube player code here, so it is fetched and
+# parsed once rather than again in every fresh container home directory.
+YTDLP_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.ytdlp_cache')
+os.makedirs(YTDLP_CACHE_DIR, exist_ok=True)
+# When set, /audio responses hand the file to nginx instead of sending it from
+# Python. nginx needs a matching internal location, e.g. for '/internal_audio/':
+#   location /internal_audio/ { internal; alias /path/to/temp_audio/; }
+AUDIO_ACCEL_REDIRECT_PREFIX = os.environ.get('AUDIO_ACCEL_REDIRECT_PREFIX')
+# Behind Apache with mod_xsendfile, USE_X_SENDFILE=1 makes every send_file()
+# response an X-Sendfile header with the absolute path instead of a body.
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 
 # --- Cookies & API ---
 COOKIES_FILE_PATH = 'cookies.txt'
 absolute_cookies_path = os.path.abspath(COOKIES_FILE_PATH)
+# Unauthenticated client: song search needs no account, and the constructor
+# makes no network calls, so it is safe to build before gunicorn forks.
+ytmusic = YTMusic()
+# Stat'ed at most once a minute rather than per request, so a cookies file that
+# is added, replaced or removed while running is still picked up.
+COOKIES_RECHECK_SECONDS = 60
+
+def _stat_cookies():
+    try:
+        return os.stat(absolute_cookies_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+_cookies_version = _stat_cookies()
+_cookies_checked_at = time.monotonic()
+
+def cookies_version():
+    # None without a cookies file, otherwise its mtime.
+    global _cookies_version, _cookies_checked_at
+    now = time.monotonic()
+    if now - _cookies_checked_at >= COOKIES_RECHECK_SECONDS:
+        _cookies_checked_at = now
+        _cookies_version = _stat_cookies()
+    return _cookies_version
+
+# --- Temp File Naming ---
+# Names only need to be unique within TEMP_DIR, so a per-process prefix plus a
+# counter avoids reading from the OS random source on every request. The random
+# part of the prefix keeps names from a restarted process with a reused PID apart.
+_name_counter = itertools.count()
+
+def _reset_name_prefix():
+    global _name_prefix
+    _name_prefix = f"{os.getpid()}-{secrets.token_hex(4)}"
+
+_reset_name_prefix()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_name_prefix)
+
+def next_temp_name():
+    return f"{_name_prefix}-{next(_name_counter)}"
 
 # --- File Cleanup ---
+FILE_TTL_SECONDS = 3600
+MAX_TEMP_FILES = 500
+JANITOR_INTERVAL_SECONDS = 60
+PARTIAL_SUFFIXES = ('.part', '.ytdl')
+
+# Prepared files known to this process, least recently used first. Preparing a
+# song appends its file and serving it from /audio moves it to the end, so a
+# track that keeps being replayed outlives FILE_TTL_SECONDS while idle ones are
+# evicted from the front without any directory scan or per-file stat.
+_temp_lru = OrderedDict()
+_temp_lru_lock = Lock()
+
+def track_temp_file(file_path):
+    with _temp_lru_lock:
+        _temp_lru[os.path.basename(file_path)] = time.time()
+
+def touch_temp_file(filename):
+    with _temp_lru_lock:
+        if filename in _temp_lru:
+            _temp_lru[filename] = time.time()
+            _temp_lru.move_to_end(filename)
+
+def _seed_temp_lru():
+    # Picks up files left by earlier or restarted processes, oldest first.
+    entries = []
+    with os.scandir(TEMP_DIR) as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False) and not entry.name.endswith(PARTIAL_SUFFIXES):
+                entries.append((entry.stat().st_mtime, entry.name))
+    with _temp_lru_lock:
+        _temp_lru.clear()
+        for mtime, name in sorted(entries):
+            _temp_lru[name] = mtime
+
+def _janitor():
+    while True:
+        time.sleep(JANITOR_INTERVAL_SECONDS)
+        cutoff = time.time() - FILE_TTL_SECONDS
+        expired = []
+        with _temp_lru_lock:
+            while _temp_lru:
+                filename, last_used = next(iter(_temp_lru.items()))
+                if last_used > cutoff and len(_temp_lru) <= MAX_TEMP_FILES:
+                    break
+                _temp_lru.popitem(last=False)
+                expired.append(filename)
+        for filename in expired:
+            try:
+                os.remove(os.path.join(TEMP_DIR, filename))
+                logger.info("Cleaned up expired file: %s", filename)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error("Error removing %s: %s", filename, e)
+
 def cleanup_old_files():
+    # Fallback for what the LRU never sees: partial downloads left behind by
+    # failed requests. Other names are skipped before any stat call.
     while True:
         time.sleep(600)
         try:
-            for filename in os.listdir(TEMP_DIR):
-                file_path = os.path.join(TEMP_DIR, filename)
-                if os.path.isfile(file_path) and (time.time() - os.path.getmtime(file_path)) > 3600:
-                    os.remove(file_path)
-                    logger.info(f"Cleaned up old file: {filename}")
+            now = time.time()
+            with os.scandir(TEMP_DIR) as it:
+                for entry in it:
+                    if not entry.name.endswith(PARTIAL_SUFFIXES) or not entry.is_file(follow_symlinks=False):
+                        continue
+                    if now - entry.stat().st_mtime > FILE_TTL_SECONDS:
+                        try:
+                            os.remove(entry.path)
+                            logger.info("Cleaned up partial download: %s", entry.name)
+                        except FileNotFoundError:
+                            pass
+            trim_audio_cache()
         except Exception as e:
-            logger.error(f"Error during file cleanup: {e}")
+            logger.error("Error during file cleanup: %s", e)
 
 # --- Helper ---
-def get_ydl_opts():
-    opts = {'format': 'bestaudio[ext=webm]/bestaudio/best', 'noplaylist': True, 'quiet': True, 'no_warnings': True}
-    if os.path.exists(absolute_cookies_path):
-        opts['cookiefile'] = absolute_cookies_path
-    return opts
+# yt-dlp reports through the 'yt_dlp' logger, so its warnings and errors land in
+# the app log. YTDLP_VERBOSE=1 adds its debug output while diagnosing extraction.
+YTDLP_VERBOSE = os.environ.get('YTDLP_VERBOSE') == '1'
+ydl_logger = logging.getLogger('yt_dlp')
+ydl_logger.setLevel(logging.DEBUG if YTDLP_VERBOSE else logging.WARNING)
+
+# Audio-only streams are preferred, and 'abr:160' caps the pick at ~160 kbps so
+# the occasional high-bitrate Opus variant is not downloaded for the same
+# playback quality.
+_ydl_opts = {
+    'format': 'bestaudio[ext=webm]/bestaudio[acodec=opus]/bestaudio/best',
+    'format_sort': ['abr:160'],
+    'noplaylist': True,
+    'quiet': not YTDLP_VERBOSE,
+    'no_warnings': not YTDLP_VERBOSE,
+    'verbose': YTDLP_VERBOSE,
+    'logger': ydl_logger,
+    # Keep mtime at download time; the cleanup sweep and cache eviction rely on it.
+    'updatetime': False,
+    'cachedir': YTDLP_CACHE_DIR,
+}
+YDL_OPTS_BASE = MappingProxyType(_ydl_opts)
+
+def get_ydl_opts(**overrides):
+    return {**YDL_OPTS_BASE, **overrides}
+
+# --- yt-dlp Instance Pool ---
+# Constructing a YoutubeDL validates options, loads the cookie jar and builds
+# the URL opener, so instances are reused across requests. An instance is only
+# ever used by one request at a time; each pool grows to the peak concurrency.
+# Each pooled instance is stored with the cookies file version it loaded, and is
+# replaced once the file has been added, replaced or removed since.
+_YDL_POOL_OPTS = {
+    'search': MappingProxyType(get_ydl_opts(extract_flat=True, default_search='ytsearch1')),
+    'download': MappingProxyType(get_ydl_opts()),
+}
+_ydl_pools = {kind: queue.SimpleQueue() for kind in _YDL_POOL_OPTS}
+
+@contextmanager
+def pooled_ydl(kind):
+    pool = _ydl_pools[kind]
+    version = cookies_version()
+    while True:
+        try:
+            ydl_version, ydl = pool.get_nowait()
+        except queue.Empty:
+            opts = dict(_YDL_POOL_OPTS[kind])
+            if version is not None:
+                opts['cookiefile'] = absolute_cookies_path
+            ydl_version, ydl = version, yt_dlp.YoutubeDL(opts)
+            break
+        if ydl_version == version:
+            break
+        _close_ydl(ydl)
+    try:
+        yield ydl
+    finally:
+        pool.put((ydl_version, ydl))
+
+def _close_ydl(ydl):
+    # close() would also write the instance's in-memory cookie jar back to
+    # cookies.txt. That jar is as old as the instance and every pooled instance
+    # in every worker would write it, clobbering a freshly replaced file, so
+    # only the HTTP connections are closed.
+    ydl.params['cookiefile'] = None
+    ydl.close()
+
+def _close_pooled_ydls():
+    for pool in _ydl_pools.values():
+        while True:
+            try:
+                _close_ydl(pool.get_nowait()[1])
+            except queue.Empty:
+                break
+
+atexit.register(_close_pooled_ydls)
+
+# Bounds how many downloads each worker runs against googlevideo at once, so a
+# burst of requests queues here instead of getting the server rate-limited.
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 8))
+_download_slots = BoundedSemaphore(MAX_CONCURRENT_DOWNLOADS)
+
+# --- Search ---
+# Popular queries repeat, so flat search results are kept for a day and a
+# repeat lookup skips the round trip to YouTube. A video ID for a given query
+# rarely changes within that window. Each result is also filed under its own
+# title, which is what a client re-searching a track it was shown will send.
+SEARCH_CACHE_TTL_SECONDS = 24 * 3600
+_search_cache = TTLCache(maxsize=8192, ttl=SEARCH_CACHE_TTL_SECONDS)
+_search_lock = Lock()
+_search_inflight = {}
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+def build_song_details(song_info):
+    return {
+        "title": song_info.get('title', 'Unknown Title'),
+        "artist": song_info.get('artist') or song_info.get('channel') or 'Unknown Artist',
+        "video_id": song_info.get('id'),
+        "duration_seconds": song_info.get('duration', 0),
+        "thumbnail_url": song_info.get('thumbnail', ''),
+    }
+
+def build_ytmusic_details(result):
+    thumbnails = result.get('thumbnails') or [{}]
+    artists = ', '.join(artist['name'] for artist in result.get('artists') or [] if artist.get('name'))
+    return {
+        "title": result.get('title') or 'Unknown Title',
+        "artist": artists or 'Unknown Artist',
+        "video_id": result['videoId'],
+        "duration_seconds": result.get('duration_seconds', 0),
+        # YouTube Music lists thumbnails smallest first.
+        "thumbnail_url": thumbnails[-1].get('url', ''),
+    }
+
+def _lookup_song(search_query):
+    # YouTube Music's song search is a single JSON API call, well ahead of a
+    # yt-dlp flat search; yt-dlp is the fallback when it fails or finds nothing.
+    try:
+        results = ytmusic.search(search_query, filter='songs', limit=1)
+    except Exception:
+        logger.warning("SEARCH: YouTube Music search failed for \"%s\"", search_query, exc_info=True)
+        results = []
+    for result in results:
+        if result.get('videoId'):
+            return build_ytmusic_details(result)
+    with pooled_ydl('search') as ydl:
+        info = ydl.extract_info(search_query, download=False)
+    if not info.get('entries'):
+        raise yt_dlp.utils.DownloadError("No video found from search.")
+    return build_song_details(info['entries'][0])
+
+def search_song(search_query):
+    # Concurrent misses for the same query share one lookup: the first caller
+    # runs it and the rest wait on its Future instead of searching again.
+    key = normalize_query(search_query)
+    with _search_lock:
+        song_details = _search_cache.get(key)
+        pending = None if song_details is not None else _search_inflight.get(key)
+        leader = song_details is None and pending is None
+        if leader:
+            pending = _search_inflight[key] = Future()
+    if leader:
+        try:
+            song_details = _lookup_song(search_query)
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with _search_lock:
+                if song_details is not None:
+                    _search_cache[key] = song_details
+                    _search_cache.setdefault(normalize_query(song_details['title']), song_details)
+                _search_inflight.pop(key, None)
+        pending.set_result(song_details)
+    elif song_details is None:
+        song_details = pending.result()
+    # Callers get their own copy so they cannot alter the cached entry.
+    return dict(song_details)
+
+def watch_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+# --- Audio Cache ---
+# Finished downloads are hard-linked into CACHE_DIR as {video_id}.{ext}, so a
+# song requested again under a different query is linked instead of downloaded.
+# Eviction is oldest-mtime-first once the cache grows past CACHE_MAX_BYTES.
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+def link_cached_audio(video_id):
+    for cached_path in glob.glob(os.path.join(CACHE_DIR, f"{glob.escape(video_id)}.*")):
+        output_path = os.path.join(TEMP_DIR, next_temp_name() + os.path.splitext(cached_path)[1])
+        try:
+            os.link(cached_path, output_path)
+        except FileNotFoundError:
+            continue
+        os.utime(cached_path)
+        return output_path
+    return None
+
+def find_cached_audio(video_id):
+    matches = glob.glob(os.path.join(CACHE_DIR, f"{glob.escape(video_id)}.*"))
+    return matches[0] if matches else None
+
+def store_cached_audio(video_id, source_path, ext):
+    cached_path = os.path.join(CACHE_DIR, f"{video_id}.{ext}")
+    try:
+        os.link(source_path, cached_path)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        logger.warning("Could not cache %s: %s", source_path, e)
+
+def trim_audio_cache():
+    entries = []
+    with os.scandir(CACHE_DIR) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            logger.info("Evicted cached audio: %s", os.path.basename(path))
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+# --- Downloads ---
+MAX_BULK_QUERIES = 20
+def download_audio(ydl, video_id):
+    # yt-dlp fills in the extension of whichever format it actually picked.
+    ydl.params['outtmpl']['default'] = os.path.join(TEMP_DIR, f"{next_temp_name()}.%(ext)s")
+    song_info = ydl.extract_info(watch_url(video_id), download=True)
+    output_path = song_info['requested_downloads'][0]['filepath']
+    store_cached_audio(video_id, output_path, song_info['ext'])
+    return output_path
+
+# Different queries can resolve to the same video. Downloads hold that video's
+# lock and re-check the cache under it, so a racing request links the file the
+# first one fetched. Locks are taken after a download slot, never before.
+_video_locks = weakref.WeakValueDictionary()
+_video_locks_lock = Lock()
+
+def video_lock(video_id):
+    with _video_locks_lock:
+        lock = _video_locks.get(video_id)
+        if lock is None:
+            lock = _video_locks[video_id] = Lock()
+        return lock
+
+def prepare_audio(search_query):
+    # Runs on the prepare executor once get_prepare_job found no cached audio.
+    # The flat search (already cached by then) only resolves the video ID; full
+    # extraction runs once, on the watch URL. The search result is what is
+    # returned, so song_details match /get_song_info. The audio cache is checked
+    # again under the video's lock in case another query fetched it meanwhile.
+    song_details = search_song(search_query)
+    video_id = song_details['video_id']
+    with _download_slots, video_lock(video_id):
+        output_path = link_cached_audio(video_id)
+        if output_path:
+            logger.info("CACHE: Reusing audio downloaded meanwhile for \"%s\"", search_query)
+        else:
+            logger.info("DOWNLOAD: Starting download for: \"%s\"", search_query)
+            with pooled_ydl('download') as ydl:
+                output_path = download_audio(ydl, video_id)
+            logger.info("DOWNLOAD: Finished for \"%s\"", search_query)
+    track_temp_file(output_path)
+    return song_details, output_path
+
+# --- Prepare Jobs ---
+# One Future per normalized query. Concurrent requests for the same song wait
+# on the same Future, and a finished Future doubles as the result cache until
+# it expires. Entries expire well before the janitor could evict their file, so
+# a hit leaves time to fetch it. The search and audio-cache lookup run on the
+# request thread and a hit becomes an already finished Future; only downloads
+# go to the executor, so a cached track never queues behind them.
+PREPARED_CACHE_TTL_SECONDS = FILE_TTL_SECONDS // 2
+_prepare_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS, thread_name_prefix='prepare')
+_prepare_jobs = TTLCache(maxsize=1024, ttl=PREPARED_CACHE_TTL_SECONDS)
+_prepare_jobs_lock = Lock()
+
+def _job_is_reusable(job):
+    if not job.done():
+        return True
+    return job.exception() is None and os.path.exists(job.result()[1])
+
+def get_prepare_job(search_query):
+    job_id = normalize_query(search_query)
+    with _prepare_jobs_lock:
+        job = _prepare_jobs.get(job_id)
+    if job is not None and _job_is_reusable(job):
+        return job_id, job
+
+    song_details = search_song(search_query)
+    output_path = link_cached_audio(song_details['video_id'])
+    if output_path:
+        logger.info("CACHE: Reusing downloaded audio for \"%s\"", search_query)
+        track_temp_file(output_path)
+    with _prepare_jobs_lock:
+        job = _prepare_jobs.get(job_id)
+        if job is None or not _job_is_reusable(job):
+            if output_path:
+                job = Future()
+                job.set_result((song_details, output_path))
+            else:
+                job = _prepare_executor.submit(prepare_audio, search_query)
+            _prepare_jobs[job_id] = job
+    return job_id, job
+
+def find_prepare_job(job_id):
+    with _prepare_jobs_lock:
+        return _prepare_jobs.get(job_id)
+
+def prepared_song_response(job):
+    song_details, output_path = job.result()
+    output_filename = os.path.basename(output_path)
+    touch_temp_file(output_filename)
+    play_url = f"/audio/{output_filename}"
+    return jsonify({"status": "success", "song_details": song_details, "play_url": play_url})
+
+# --- Streaming ---
+# Resolved googlevideo URLs are bound to the IP that resolved them, so the
+# client cannot be redirected to them; they are cached and proxied instead.
+# Where clients share the server's public IP (a home or desktop deployment),
+# STREAM_REDIRECT=1 sends uncached tracks to googlevideo with a 302 instead.
+STREAM_REDIRECT = os.environ.get('STREAM_REDIRECT') == '1'
+STREAM_CHUNK_SIZE = 64 * 1024
+AUDIO_URL_TTL_SECONDS = 3600
+AUDIO_MIMETYPES = {'webm': 'audio/webm', 'm4a': 'audio/mp4', 'mp4': 'audio/mp4', 'opus': 'audio/ogg', 'ogg': 'audio/ogg', 'mp3': 'audio/mpeg'}
+# A play URL names one file that is never rewritten, so clients and CDNs may
+# keep it for good; replays and seeks are then answered from their cache.
+AUDIO_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+_audio_url_cache = TTLCache(maxsize=1024, ttl=AUDIO_URL_TTL_SECONDS)
+_audio_url_lock = Lock()
+
+def resolve_audio_format(search_query):
+    key = normalize_query(search_query)
+    with _audio_url_lock:
+        audio_format = _audio_url_cache.get(key)
+    if audio_format is not None:
+        return audio_format
+
+    video_id = search_song(search_query)['video_id']
+    with pooled_ydl('download') as ydl:
+        song_info = ydl.extract_info(watch_url(video_id), download=False)
+    audio_format = {
+        'video_id': song_info['id'],
+        'url': song_info['url'],
+        'ext': song_info['ext'],
+        'http_headers': song_info.get('http_headers', {}),
+    }
+    with _audio_url_lock:
+        _audio_url_cache[key] = audio_format
+    return audio_format
+
+def _open_upstream(ydl, audio_format):
+    return ydl.urlopen(YtdlRequest(audio_format['url'], headers=audio_format['http_headers']))
+
+def open_audio_stream(ydl, search_query):
+    # The response reads from ydl's connection, so the caller keeps ydl checked
+    # out until it has finished with the response.
+    audio_format = resolve_audio_format(search_query)
+    try:
+        return audio_format, _open_upstream(ydl, audio_format)
+    except UpstreamHTTPError:
+        # The cached URL was revoked before its TTL; resolve it once more.
+        with _audio_url_lock:
+            _audio_url_cache.pop(normalize_query(search_query), None)
+        audio_format = resolve_audio_format(search_query)
+        return audio_format, _open_upstream(ydl, audio_format)
+
+def download_error_response(de):
+    error_string = str(de).lower()
+    if 'sign in' in error_string or 'authentication' in error_string:
+        return jsonify({"error": "Authentication Error: Cookies may be invalid."}), 403
+    else:
+        return jsonify({"error": "A download error occurred."}), 500
 
 # --- Endpoints ---
 @app.route('/')
@@ -53,30 +581,14 @@ def get_song_info():
     if not search_query:
         return jsonify({"error": "Search query is required"}), 400
     
-    logger.info(f"INFO: Request for query: \"{search_query}\"")
+    logger.info("INFO: Request for query: \"%s\"", search_query)
     
     try:
-        ydl_opts = get_ydl_opts()
-        ydl_opts['extract_flat'] = True
-        ydl_opts['default_search'] = 'ytsearch1'
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(search_query, download=False)
-            if not info.get('entries'):
-                raise yt_dlp.utils.DownloadError("No video found from search.")
-            song_info = info['entries'][0]
-
-        song_details = {
-            "title": song_info.get('title', 'Unknown Title'),
-            "artist": song_info.get('artist') or song_info.get('channel') or 'Unknown Artist',
-            "video_id": song_info.get('id'),
-            "duration_seconds": song_info.get('duration', 0),
-            "thumbnail_url": song_info.get('thumbnail', ''),
-        }
+        song_details = search_song(search_query)
         return jsonify({"status": "success", "song_details": song_details})
 
-    except Exception as e:
-        logger.error(f"INFO: Unexpected error for \"{search_query}\": {e}", exc_info=True)
+    except Exception:
+        logger.error("INFO: Unexpected error for \"%s\"", search_query, exc_info=True)
         return jsonify({"error": "An unexpected server error occurred."}), 500
 
 
@@ -86,51 +598,174 @@ def prepare_song():
     if not search_query:
         return jsonify({"error": "Search query is required"}), 400
 
-    logger.info(f"PREPARE: Request for query: \"{search_query}\"")
+    logger.info("PREPARE: Request for query: \"%s\"", search_query)
     try:
-        output_filename = f"{uuid.uuid4()}.webm"
-        output_path = os.path.join(TEMP_DIR, output_filename)
-        
-        ydl_opts = get_ydl_opts()
-        ydl_opts['outtmpl'] = output_path
-        ydl_opts['default_search'] = 'ytsearch1'
-
-        logger.info(f"DOWNLOAD: Starting search and download for: \"{search_query}\"")
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(search_query, download=True)
-            if not info.get('entries'):
-                raise yt_dlp.utils.DownloadError("No video found from search.")
-            song_info = info['entries'][0]
-
-        logger.info(f"DOWNLOAD: Finished for \"{search_query}\"")
-        song_details = {
-            "title": song_info.get('title', 'Unknown Title'),
-            "artist": song_info.get('artist') or song_info.get('channel') or 'Unknown Artist',
-            "video_id": song_info.get('id'),
-            "duration_seconds": song_info.get('duration', 0),
-            "thumbnail_url": song_info.get('thumbnail', ''),
-        }
-        play_url = f"/audio/{output_filename}"
-
-        return jsonify({"status": "success", "song_details": song_details, "play_url": play_url})
+        job_id, job = get_prepare_job(search_query)
+        # With ?async=1 the client gets a job ID at once and polls /job/<job_id>.
+        if request.args.get('async') == '1' and not job.done():
+            return jsonify({"status": "pending", "job_id": job_id}), 202
+        return prepared_song_response(job)
 
     except yt_dlp.utils.DownloadError as de:
-        error_string = str(de).lower()
-        if 'sign in' in error_string or 'authentication' in error_string:
-            return jsonify({"error": "Authentication Error: Cookies may be invalid."}), 403
-        else:
-            return jsonify({"error": "A download error occurred."}), 500
-    except Exception as e:
-        logger.error(f"PREPARE: Unexpected error for \"{search_query}\": {e}", exc_info=True)
+        return download_error_response(de)
+    except Exception:
+        logger.error("PREPARE: Unexpected error for \"%s\"", search_query, exc_info=True)
+        return jsonify({"error": "An unexpected server error occurred."}), 500
+
+@app.route('/job/<path:job_id>', methods=['GET'])
+def get_job(job_id):
+    job = find_prepare_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    if not job.done():
+        return jsonify({"status": "pending", "job_id": job_id}), 202
+
+    try:
+        return prepared_song_response(job)
+    except yt_dlp.utils.DownloadError as de:
+        return download_error_response(de)
+    except Exception:
+        logger.error("JOB: Unexpected error for job \"%s\"", job_id, exc_info=True)
+        return jsonify({"error": "An unexpected server error occurred."}), 500
+
+@app.route('/prepare_songs', methods=['GET'])
+def prepare_songs():
+    # Repeated ?query= parameters rather than one comma-separated value, since
+    # song titles often contain commas.
+    search_queries = request.args.getlist('query')
+    if not search_queries:
+        return jsonify({"error": "At least one search query is required"}), 400
+    if len(search_queries) > MAX_BULK_QUERIES:
+        return jsonify({"error": f"At most {MAX_BULK_QUERIES} queries are allowed"}), 400
+
+    logger.info("PREPARE_BULK: Request for %d queries", len(search_queries))
+    try:
+        songs = []
+        for search_query in search_queries:
+            try:
+                songs.append({"query": search_query, "song_details": search_song(search_query)})
+            except yt_dlp.utils.DownloadError:
+                songs.append({"query": search_query, "error": "No video found from search."})
+
+        # The whole batch runs on one checked-out instance, so its connections
+        # and cached player code carry over from one track to the next.
+        with _download_slots, pooled_ydl('download') as ydl:
+            for song in songs:
+                if 'error' in song:
+                    continue
+                video_id = song['song_details']['video_id']
+                with video_lock(video_id):
+                    output_path = link_cached_audio(video_id)
+                    if not output_path:
+                        try:
+                            output_path = download_audio(ydl, video_id)
+                        except yt_dlp.utils.DownloadError:
+                            song['error'] = "A download error occurred."
+                            continue
+                track_temp_file(output_path)
+                song['play_url'] = f"/audio/{os.path.basename(output_path)}"
+
+        return jsonify({"status": "success", "songs": songs})
+
+    except Exception:
+        logger.error("PREPARE_BULK: Unexpected error", exc_info=True)
+        return jsonify({"error": "An unexpected server error occurred."}), 500
+
+@app.route('/stream_song', methods=['GET'])
+def stream_song():
+    search_query = request.args.get('query')
+    if not search_query:
+        return jsonify({"error": "Search query is required"}), 400
+
+    logger.info("STREAM: Request for query: \"%s\"", search_query)
+    # Holds the pooled instance the upstream response is read through until the
+    # server is done with the response, so no other request can use it mid-track.
+    stream_resources = ExitStack()
+    try:
+        # The cached search result names the video, so a track already on disk
+        # is served without resolving its stream URL with YouTube first.
+        cached_path = find_cached_audio(search_song(search_query)['video_id'])
+        if cached_path:
+            mimetype = AUDIO_MIMETYPES.get(os.path.splitext(cached_path)[1][1:].lower(), 'application/octet-stream')
+            try:
+                logger.info("CACHE: Streaming cached audio for \"%s\"", search_query)
+                return send_file(cached_path, mimetype=mimetype)
+            except FileNotFoundError:
+                pass  # Evicted since the lookup; proxy it instead.
+        if STREAM_REDIRECT:
+            logger.info("STREAM: Redirecting to upstream for \"%s\"", search_query)
+            return redirect(resolve_audio_format(search_query)['url'], code=302)
+        ydl = stream_resources.enter_context(pooled_ydl('download'))
+        audio_format, upstream = open_audio_stream(ydl, search_query)
+        stream_resources.callback(upstream.close)
+    except yt_dlp.utils.DownloadError as de:
+        stream_resources.close()
+        return download_error_response(de)
+    except Exception:
+        stream_resources.close()
+        logger.error("STREAM: Unexpected error for \"%s\"", search_query, exc_info=True)
         return jsonify({"error": "An unexpected server error occurred."}), 500
 
+    # The bytes are teed to a partial file and, once the whole track has been
+    # relayed, linked into the audio cache so later plays come from disk.
+    part_path = os.path.join(TEMP_DIR, f"{next_temp_name()}.{audio_format['ext']}.part")
+    expected_size = upstream.headers.get('Content-Length')
+
+    def generate():
+        # The finally block also runs when the client disconnects mid-track.
+        received = 0
+        try:
+            with open(part_path, 'wb') as part_file:
+                while chunk := upstream.read(STREAM_CHUNK_SIZE):
+                    part_file.write(chunk)
+                    received += len(chunk)
+                    yield chunk
+            if expected_size is not None and received == int(expected_size):
+                store_cached_audio(audio_format['video_id'], part_path, audio_format['ext'])
+        finally:
+            try:
+                os.remove(part_path)
+            except FileNotFoundError:
+                pass
+
+    response = Response(generate(), mimetype=AUDIO_MIMETYPES.get(audio_format['ext'], 'application/octet-stream'))
+    # Runs after generate() is closed, or in its place if it never started:
+    # closes the upstream response, then returns the instance to the pool.
+    response.call_on_close(stream_resources.close)
+    return response
+
 @app.route('/audio/<filename>')
 def serve_audio(filename):
-    logger.info(f"SERVE: Client requesting audio file: {filename}")
-    return send_from_directory(TEMP_DIR, filename, as_attachment=False)
+    logger.info("SERVE: Client requesting audio file: %s", filename)
+    touch_temp_file(filename)
+    # Set explicitly: mimetypes.guess_type() maps .webm to video/webm and may not
+    # know .m4a or .opus at all on slim images.
+    mimetype = AUDIO_MIMETYPES.get(os.path.splitext(filename)[1][1:].lower(), 'application/octet-stream')
+    if AUDIO_ACCEL_REDIRECT_PREFIX:
+        file_path = safe_join(TEMP_DIR, filename)
+        if file_path is None or not os.path.isfile(file_path):
+            abort(404)
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = f"{AUDIO_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{filename}"
+    else:
+        # conditional=True answers If-None-Match/If-Modified-Since with 304 and
+        # Range requests with 206, so a seek only reads the bytes it needs.
+        response = send_from_directory(TEMP_DIR, filename, as_attachment=False, mimetype=mimetype,
+                                       conditional=True, etag=filename)
+    response.headers['Cache-Control'] = AUDIO_CACHE_CONTROL
+    return response
+
+# The janitor and the partial-file sweep only belong in processes that serve
+# requests: only those see /audio hits, so the LRU index of any other process
+# would expire files that workers are still replaying. Under gunicorn the
+# post_fork hook in gunicorn.conf.py starts them in each worker, never in the
+# master that preloads this module; the __main__ block starts them for app.run.
+def start_background_threads():
+    _seed_temp_lru()
+    Thread(target=_janitor, daemon=True).start()
+    Thread(target=cleanup_old_files, daemon=True).start()
 
 if __name__ == '__main__':
-    cleanup_thread = Thread(target=cleanup_old_files, daemon=True)
-    cleanup_thread.start()
+    start_background_threads()
     port = int(os.environ.get('PORT', 5001))
     app.run(host='0.0.0.0', port=port, debug=False, threaded=True)